@@ -1,34 +1,111 @@
 import psutil
 import os
-import json
+import sys
+import socket
+import argparse
+import re
 import datetime
 import pwd
 import grp
 import subprocess
+import importlib.metadata
 import platform
-import pkg_resources
-import cpuinfo
-import GPUtil
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import orjson
+
+SUBPROCESS_BUFSIZE = 1024 * 1024
+PROC_BUFSIZE = 64 * 1024
+
+# 'Key: value' (/proc/meminfo) and 'key value' (/proc/vmstat) counter lines
+_PROC_COUNTER_RE = re.compile(rb'^(\w+):?[ \t]+(\d+)', re.M)
+
+# key = value lines, skipping blanks and '#' comments
+_SYSCTL_RE = re.compile(r'^[ \t]*([^#=\s][^=\n]*?)[ \t]*=[ \t]*(.*?)[ \t]*$', re.M)
+
+def _safe_usage(mountpoint):
+    try:
+        usage = psutil.disk_usage(mountpoint)._asdict()
+        usage['mountpoint'] = mountpoint
+        return usage
+    except Exception:
+        return None
+
 
 #  'disk_usage': {part.mountpoint: psutil.disk_usage(part.mountpoint)._asdict() for part in psutil.disk_partitions()},
-def gather_disk_usage_info():
+def gather_disk_usage_info(partitions=None):
     disk_usage = []
     try:
-        for partition in psutil.disk_partitions(all=True):
-            try:
-                usage = psutil.disk_usage(partition.mountpoint)._asdict()
-                usage['mountpoint'] = partition.mountpoint
-                disk_usage.append(usage)
-            except Exception as e1:
-                pass
+        if partitions is None:
+            partitions = psutil.disk_partitions(all=True)
+        if not partitions:
+            return disk_usage
+        # statvfs can block on network filesystems, so query the mountpoints side by side
+        with ThreadPoolExecutor(max_workers=min(32, len(partitions))) as executor:
+            usages = executor.map(_safe_usage, [partition.mountpoint for partition in partitions])
+            disk_usage = [usage for usage in usages if usage is not None]
     except Exception as e2:
         pass
 
     return disk_usage
 
 
+def read_proc_counters(path):
+    with open(path, 'rb', buffering=PROC_BUFSIZE) as f:
+        data = f.read()
+    return {key.decode(): int(value) for key, value in _PROC_COUNTER_RE.findall(data)}
+
+
+def _percent(used, total):
+    return round(used / total * 100, 1) if total else 0.0
+
+
+def get_memory_info():
+    # same fields and derivations as psutil.virtual_memory()/swap_memory(),
+    # from one read of /proc/meminfo and /proc/vmstat
+    meminfo = {key: value * 1024 for key, value in read_proc_counters('/proc/meminfo').items()}
+    vmstat = read_proc_counters('/proc/vmstat')
+
+    total = meminfo.get('MemTotal', 0)
+    free = meminfo.get('MemFree', 0)
+    buffers = meminfo.get('Buffers', 0)
+    cached = meminfo.get('Cached', 0) + meminfo.get('SReclaimable', 0)
+    available = meminfo.get('MemAvailable') or free + buffers + cached
+    if available > total:
+        available = free
+
+    swap_total = meminfo.get('SwapTotal', 0)
+    swap_free = meminfo.get('SwapFree', 0)
+
+    memory_info = {
+        'virtual_memory': {
+            'total': total,
+            'available': available,
+            'percent': _percent(total - available, total),
+            'used': total - available,
+            'free': free,
+            'active': meminfo.get('Active', 0),
+            'inactive': meminfo.get('Inactive', 0),
+            'buffers': buffers,
+            'cached': cached,
+            'shared': meminfo.get('Shmem', 0),
+            'slab': meminfo.get('Slab', 0)
+        },
+        'swap_memory': {
+            'total': swap_total,
+            'used': swap_total - swap_free,
+            'free': swap_free,
+            'percent': _percent(swap_total - swap_free, swap_total),
+            'sin': vmstat.get('pswpin', 0) * 4 * 1024,
+            'sout': vmstat.get('pswpout', 0) * 4 * 1024
+        }
+    }
+    return memory_info
+
+
 def get_load_avg():
-    load_avg = psutil.getloadavg()
+    with open('/proc/loadavg', 'rb', buffering=PROC_BUFSIZE) as f:
+        load_avg = [float(value) for value in f.read().split()[:3]]
     load_avg_dict = {
         '1_min_load': load_avg[0],
         '5_min_load': load_avg[1],
@@ -38,6 +115,9 @@ def get_load_avg():
 
 
 def get_cpu_info():
+    # imported here, cpuinfo is slow to load and only needed for this section
+    import cpuinfo
+
     cpu_info = cpuinfo.get_cpu_info()
     # Collecting information
     cpu_details = {
@@ -94,9 +174,77 @@ def get_net_if_stats():
         net_if_stats.append(net_if)
     return net_if_stats
 
-def get_net_if_connections():
+_TCP_STATES = {
+    '01': 'ESTABLISHED',
+    '02': 'SYN_SENT',
+    '03': 'SYN_RECV',
+    '04': 'FIN_WAIT1',
+    '05': 'FIN_WAIT2',
+    '06': 'TIME_WAIT',
+    '07': 'CLOSE',
+    '08': 'CLOSE_WAIT',
+    '09': 'LAST_ACK',
+    '0A': 'LISTEN',
+    '0B': 'CLOSING',
+}
+
+_PROC_NET_FILES = [
+    ('/proc/net/tcp', socket.AF_INET, socket.SOCK_STREAM),
+    ('/proc/net/tcp6', socket.AF_INET6, socket.SOCK_STREAM),
+    ('/proc/net/udp', socket.AF_INET, socket.SOCK_DGRAM),
+    ('/proc/net/udp6', socket.AF_INET6, socket.SOCK_DGRAM),
+]
+
+
+def decode_proc_net_address(address, family):
+    ip, port = address.split(':')
+    port = int(port, 16)
+    if not port:
+        return None, None
+    ip = bytes.fromhex(ip)
+    # the kernel prints each 32-bit word of the address in host byte order
+    if sys.byteorder == 'little':
+        ip = b''.join(ip[i:i + 4][::-1] for i in range(0, len(ip), 4))
+    return socket.inet_ntop(family, ip), port
+
+
+def read_proc_net_connections():
+    net_connections = []
+    for path, family, sock_type in _PROC_NET_FILES:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', buffering=PROC_BUFSIZE) as f:
+            f.readline()
+            for line in f:
+                fields = line.split()
+                local_ip, local_port = decode_proc_net_address(fields[1], family)
+                remote_ip, remote_port = decode_proc_net_address(fields[2], family)
+                if sock_type == socket.SOCK_STREAM:
+                    status = _TCP_STATES.get(fields[3], 'NONE')
+                else:
+                    status = 'NONE'
+                net_connections.append({
+                    'fd': -1,
+                    'family': family,
+                    'type': sock_type,
+                    'status': status,
+                    'pid': None,
+                    'local_ip': local_ip,
+                    'local_port': local_port,
+                    'remote_ip': remote_ip,
+                    'remote_port': remote_port
+                })
+    return net_connections
+
+
+def get_net_if_connections(with_pids=False):
+    # psutil maps sockets to processes by walking every /proc/[pid]/fd,
+    # which is slow on busy hosts; only pay for it when asked to
+    if not with_pids:
+        return read_proc_net_connections()
+
     net_if_connections = []
-    for connection in psutil.net_connections():
+    for connection in psutil.net_connections(kind='inet'):
         net_conn = connection._asdict()
         net_conn['local_ip'] = net_conn['laddr'][0]
         net_conn['local_port'] = net_conn['laddr'][1]
@@ -115,28 +263,25 @@ def get_net_if_connections():
 
 #{'fd': -1, 'family': <AddressFamily.AF_INET6: 10>, 'type': <SocketKind.SOCK_STREAM: 1>, 'laddr': addr(ip='::', port=7687), 'raddr': (), 'status': 'LISTEN', 'pid': None}
 
-def gather_system_info():
+def gather_system_info(net_connection_pids=False):
+    partitions = psutil.disk_partitions(all=True)
     system_info = {
         'cpu': get_cpu_info(),
         'gpu': get_gpu_info(),
-        'memory': {
-            'virtual_memory': psutil.virtual_memory()._asdict(),
-            'swap_memory': psutil.swap_memory()._asdict()
-        },
+        'memory': get_memory_info(),
         'disk': {
-            'disk_partitions': [part._asdict() for part in psutil.disk_partitions(all=True)],
-            'disk_usage': gather_disk_usage_info(),
+            'disk_partitions': [part._asdict() for part in partitions],
+            'disk_usage': gather_disk_usage_info(partitions),
             'disk_io_counters': get_disk_io_counters()
         },
         'network': {
             'net_io_counters': get_net_io_counters(),
             'net_if_addrs': get_net_if_addrs(),
             'net_if_stats': get_net_if_stats(),
-            'net_connections': get_net_if_connections()
+            'net_connections': get_net_if_connections(net_connection_pids)
         },
         'users': [user._asdict() for user in psutil.users()],
         'boot_time': psutil.boot_time(),
-        'load_avg': os.getloadavg() if hasattr(os, 'getloadavg') else None,
         'processes': []
     }
 
@@ -150,6 +295,8 @@ def gather_system_info():
                 proc_info['memory_info'] = proc_info['memory_info']._asdict()
             if 'io_counters' in proc_info and proc_info['io_counters'] is not None:
                 proc_info['io_counters'] = proc_info['io_counters']._asdict()
+            # drop fields psutil couldn't read (None) or that are empty
+            proc_info = {key: value for key, value in proc_info.items() if value not in (None, [], {}, '')}
             system_info['processes'].append(proc_info)
         except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
             pass
@@ -178,32 +325,36 @@ def gather_platform_info():
 
 
 def gather_rpm_packages():
-    rpm_packages = []
+    rpm_packages = {}
+    cmd = ['rpm', '-qa', '--queryformat', '%{NAME} %{VERSION}-%{RELEASE}\n']
     try:
-        result = subprocess.run(['rpm', '-qa', '--queryformat', '%{NAME} %{VERSION}-%{RELEASE}\n'], capture_output=True, text=True, check=True)
-        for line in result.stdout.split('\n'):
-            if line:
-                name, version = line.split(' ', 1)
-                rpm_packages[name] = version
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=SUBPROCESS_BUFSIZE) as proc:
+            for line in proc.stdout:
+                line = line.rstrip('\n')
+                if line:
+                    name, version = line.split(' ', 1)
+                    rpm_packages[name] = version
+            returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
     except subprocess.CalledProcessError as e:
         print(f"Error gathering RPM packages: {e}")
 
     return rpm_packages
 
 
+_DPKG_FIELDS = ('Package', 'Version', 'Architecture')
+
+
 def gather_dpkg_packages():
     dpkg_packages = []
+    cmd = ['dpkg-query', '-W', '-f=${Package} ${Version} ${Architecture}\n']
     try:
-        result = subprocess.run(['dpkg-query', '-W', '-f=${Package} ${Version} ${Architecture}\n'], capture_output=True, text=True, check=True)
-        for line in result.stdout.split('\n'):
-            if line:
-                fields = line.strip().split()
-            package_info = {
-                'Package': fields[0],
-                'Version': fields[1],
-                'Architecture': fields[2],
-            }
-            dpkg_packages.append(package_info)
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=SUBPROCESS_BUFSIZE) as proc:
+            dpkg_packages = [dict(zip(_DPKG_FIELDS, line.rstrip('\n').split(' ', 2))) for line in proc.stdout if line != '\n']
+            returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd)
     except subprocess.CalledProcessError as e:
         print(f"Error gathering Debian packages: {e}")
 
@@ -212,12 +363,21 @@ def gather_dpkg_packages():
 
 def gather_installed_python_packages():
     installed_packages = []
-    for dist in pkg_resources.working_set:
+    seen = set()
+    for dist in importlib.metadata.distributions():
+        name = dist.metadata['Name']
+        if name is None:
+            continue
+        # like pkg_resources, only report the first copy found on sys.path
+        key = re.sub(r'[-_.]+', '-', name).lower()
+        if key in seen:
+            continue
+        seen.add(key)
         package_info = {
-            'name': dist.project_name,
+            'name': name,
             'version': dist.version,
-            'location': dist.location,
-            'requires': [str(req) for req in dist.requires()]
+            'location': str(dist.locate_file('')),
+            'requires': [req for req in dist.requires or [] if 'extra' not in req.partition(';')[2]]
         }
         installed_packages.append(package_info)
     return installed_packages
@@ -239,75 +399,136 @@ def check_linux_pkg_type():
     return 'Unknown'
 
 
-def read_sysctl_conf(file_path='/etc/sysctl.conf'):
+def read_sysctl_conf(file_path='/etc/sysctl.conf', conf_dir='/etc/sysctl.d'):
     sysctl_conf = {}
 
+    # like `sysctl --system`: drop-ins in name order, then sysctl.conf on top
+    conf_files = []
+    if os.path.isdir(conf_dir):
+        with os.scandir(conf_dir) as entries:
+            conf_files = sorted(entry.path for entry in entries if entry.name.endswith('.conf') and entry.is_file())
     if os.path.exists(file_path):
-        with open(file_path, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    if '=' in line:
-                        key, value = line.split('=', 1)
-                        sysctl_conf[key.strip()] = value.strip()
+        conf_files.append(file_path)
+
+    for conf_file in conf_files:
+        # an unreadable or vanished drop-in shouldn't cost the whole report
+        try:
+            with open(conf_file, 'r') as f:
+                sysctl_conf.update(_SYSCTL_RE.findall(f.read()))
+        except OSError:
+            continue
     return sysctl_conf
 
 
 def get_current_sysctl_values():
-    sysctl_values = {}
-    result = subprocess.run(['sysctl', '-a'], capture_output=True, text=True)
-
-    if result.returncode == 0:
-        for line in result.stdout.split('\n'):
-            line = line.strip()
-            if line:
-                if '=' in line:
-                    key, value = line.split('=', 1)
-                    sysctl_values[key.strip()] = value.strip()
+    with subprocess.Popen(['sysctl', '-a'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=SUBPROCESS_BUFSIZE) as proc:
+        sysctl_values = dict(_SYSCTL_RE.findall(proc.stdout.read()))
+        returncode = proc.wait()
+
+    if returncode != 0:
+        return {}
     return sysctl_values
 
-def get_users_info():
+def get_users_info(use_nss=False):
     users_info = []
-    for user in pwd.getpwall():
-        info = {
-            'username': user.pw_name,
-            'user_id': user.pw_uid,
-            'group_id': user.pw_gid,
-            'home_directory': user.pw_dir,
-            'shell': user.pw_shell,
-            'gecos': user.pw_gecos
-        }
-        users_info.append(info)
+    if use_nss:
+        for user in pwd.getpwall():
+            info = {
+                'username': user.pw_name,
+                'user_id': user.pw_uid,
+                'group_id': user.pw_gid,
+                'home_directory': user.pw_dir,
+                'shell': user.pw_shell,
+                'gecos': user.pw_gecos
+            }
+            users_info.append(info)
+        return users_info
+
+    # read the local database directly, getpwall() may go out to LDAP/SSSD
+    with open('/etc/passwd', 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split(':')
+            # skip malformed lines and NIS compat ('+'/'-') entries
+            if len(fields) != 7 or fields[0][:1] in ('+', '-'):
+                continue
+            if not (fields[2].isdigit() and fields[3].isdigit()):
+                continue
+            info = {
+                'username': fields[0],
+                'user_id': int(fields[2]),
+                'group_id': int(fields[3]),
+                'home_directory': fields[5],
+                'shell': fields[6],
+                'gecos': fields[4]
+            }
+            users_info.append(info)
     return users_info
 
-def get_groups_info():
+def get_groups_info(use_nss=False):
     groups_info = []
-    for group in grp.getgrall():
-        info = {
-            'groupname': group.gr_name,
-            'group_id': group.gr_gid,
-            'members': group.gr_mem
-        }
-        groups_info.append(info)
+    if use_nss:
+        for group in grp.getgrall():
+            info = {
+                'groupname': group.gr_name,
+                'group_id': group.gr_gid,
+                'members': group.gr_mem
+            }
+            groups_info.append(info)
+        return groups_info
+
+    with open('/etc/group', 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split(':')
+            if len(fields) != 4 or fields[0][:1] in ('+', '-'):
+                continue
+            if not fields[2].isdigit():
+                continue
+            info = {
+                'groupname': fields[0],
+                'group_id': int(fields[2]),
+                'members': fields[3].split(',') if fields[3] else []
+            }
+            groups_info.append(info)
     return groups_info
 
 
 
+_NVIDIA_SMI_QUERY = [
+    ('id', 'index', int),
+    ('name', 'name', str),
+    ('driver_version', 'driver_version', str),
+    ('total_memory_mb', 'memory.total', float),
+    ('free_memory_mb', 'memory.free', float),
+    ('used_memory_mb', 'memory.used', float),
+    ('temperature_c', 'temperature.gpu', float),
+    ('load_pct', 'utilization.gpu', float),
+    ('uuid', 'uuid', str),
+]
+
+
+def _parse_nvidia_smi_value(value, convert):
+    try:
+        return convert(value)
+    except ValueError:
+        # '[N/A]' or '[Not Supported]'
+        return None
+
+
 def get_gpu_info():
-    gpus = GPUtil.getGPUs()
-    gpus_info = []
+    query = ','.join(field for _, field, _ in _NVIDIA_SMI_QUERY)
+    try:
+        result = subprocess.run(['nvidia-smi', f'--query-gpu={query}', '--format=csv,noheader,nounits'], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return []
 
-    for gpu in gpus:
+    gpus_info = []
+    for line in result.stdout.splitlines():
+        if not line:
+            continue
+        values = [value.strip() for value in line.split(',')]
         info = {
-            'id': gpu.id,
-            'name': gpu.name,
-            'driver_version': gpu.driver,
-            'total_memory': f"{gpu.memoryTotal} MB",
-            'free_memory': f"{gpu.memoryFree} MB",
-            'used_memory': f"{gpu.memoryUsed} MB",
-            'temperature': f"{gpu.temperature} °C",
-            'load': f"{gpu.load * 100} %",
-            'uuid': gpu.uuid
+            key: _parse_nvidia_smi_value(value, convert)
+            for (key, _, convert), value in zip(_NVIDIA_SMI_QUERY, values)
         }
         gpus_info.append(info)
 
@@ -315,23 +536,73 @@ def get_gpu_info():
 
 
 
-master={}
+class StreamingJSONWriter:
+    """Write a JSON object to a binary file one top-level key at a time."""
+
+    def __init__(self, f):
+        self.f = f
+        self.first = True
+
+    def __enter__(self):
+        self.f.write(b'{')
+        return self
+
+    def write(self, key, value):
+        if not self.first:
+            self.f.write(b',')
+        self.first = False
+        self.f.write(orjson.dumps(key))
+        self.f.write(b':')
+        self.f.write(orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # leave a failed report unterminated rather than valid but incomplete
+        if exc_type is None:
+            self.f.write(b'}')
+
+
+
+parser = argparse.ArgumentParser(description='get linux host information')
+parser.add_argument('--net-connection-pids', action='store_true',
+                    help='resolve the owning process of each network connection (slow on hosts with many sockets)')
+parser.add_argument('--use-nss', action='store_true',
+                    help='list users and groups through NSS (includes LDAP/SSSD accounts, can be slow) instead of /etc/passwd and /etc/group')
+args = parser.parse_args()
+
+tasks = {}
 
-if check_linux_pkg_type() == 'debian':
-    master['system_packages'] = gather_dpkg_packages()
-elif check_linux_pkg_type() == 'rpm':
-    master['system_packages'] = gather_rpm_packages()
+pkg_type = check_linux_pkg_type()
+if pkg_type == 'debian':
+    tasks['system_packages'] = gather_dpkg_packages
+elif pkg_type == 'rpm':
+    tasks['system_packages'] = gather_rpm_packages
 
-master['python_packages'] = gather_installed_python_packages()
-master['platform_info'] = gather_platform_info()
-master['system_info'] = gather_system_info()
-master['sysctl_conf'] = read_sysctl_conf()
-master['current_sysctl'] = get_current_sysctl_values()
-master['users'] = get_users_info()
-master['groups'] = get_groups_info()
+tasks['python_packages'] = gather_installed_python_packages
+tasks['platform_info'] = gather_platform_info
+tasks['system_info'] = functools.partial(gather_system_info, args.net_connection_pids)
+tasks['sysctl_conf'] = read_sysctl_conf
+tasks['current_sysctl'] = get_current_sysctl_values
+tasks['users'] = functools.partial(get_users_info, args.use_nss)
+tasks['groups'] = functools.partial(get_groups_info, args.use_nss)
 
 timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 filename = "hostinfo_"+timestamp+".json"
-print(f"Writing hostinfo to {filename}")
-with open(filename, "w") as f:
-    f.write(json.dumps(master))
+# write under a temporary name so a failed run never leaves a partial report
+# that looks like a real one
+tmp_filename = f"{filename}.{os.getpid()}.tmp"
+
+# the collectors are independent and mostly wait on subprocesses and /proc,
+# so run them side by side; each section is written and released as soon as
+# it is ready, in the original key order
+try:
+    with ThreadPoolExecutor(max_workers=8) as executor, open(tmp_filename, "wb") as f, StreamingJSONWriter(f) as writer:
+        futures = {key: executor.submit(task) for key, task in tasks.items()}
+        for key in list(futures):
+            writer.write(key, futures.pop(key).result())
+except BaseException:
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    raise
+
+os.replace(tmp_filename, filename)
+print(f"Wrote hostinfo to {filename}")